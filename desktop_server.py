@@ -1,14 +1,268 @@
 ﻿from fastmcp import FastMCP
 import pyautogui
 import uiautomation as auto
+import comtypes
+import orjson
 import sys
 import json
+import asyncio
+import ctypes
+from ctypes import wintypes
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Create the MCP server
 mcp = FastMCP("desktop-controller")
 
+def _dumps(obj) -> str:
+    """Serializes a tool result to compact JSON with orjson."""
+    return orjson.dumps(obj).decode()
+
+# --- UI Automation Caching ---
+# Every property read on a live element is a cross-process COM round-trip.
+# A cache request makes UIA return an element's children together with the
+# properties we read during a walk in a single call.
+
+_CACHED_PROPERTIES = (
+    auto.PropertyId.NameProperty,
+    auto.PropertyId.ControlTypeProperty,
+    auto.PropertyId.BoundingRectangleProperty,
+    auto.PropertyId.ValueValueProperty,
+)
+
+def _create_cache_request():
+    """Builds a cache request that prefetches the properties used by tree walks."""
+    uia = auto._AutomationClient.instance().IUIAutomation
+    cache_request = uia.CreateCacheRequest()
+    for property_id in _CACHED_PROPERTIES:
+        cache_request.AddProperty(property_id)
+    # Match Control.GetChildren(), which walks the raw view
+    cache_request.TreeFilter = uia.RawViewCondition
+    return cache_request
+
+def _get_cached_children(element, cache_request, memo=None):
+    """
+    Returns the children of a raw UIA element with their properties cached.
+    If memo is given, children already fetched for the same element object
+    are reused instead of asking UIA again.
+    """
+    if memo is not None:
+        hit = memo.get(id(element))
+        if hit is not None:
+            return hit[1]
+    
+    found = element.FindAllBuildCache(auto.TreeScope.Children, cache_request.TreeFilter, cache_request)
+    children = [found.GetElement(i) for i in range(found.Length)] if found else []
+    
+    if memo is not None:
+        # Keep the element alive so its id() cannot be reused while cached
+        memo[id(element)] = (element, children)
+    return children
+
+# PropertyConditionFlags; MatchSubstring needs Windows 10 1809 or later
+_PROPERTY_CONDITION_IGNORE_CASE = 1
+_PROPERTY_CONDITION_MATCH_SUBSTRING = 2
+
+_CONTROL_TYPE_IDS = {name: type_id for type_id, name in auto.ControlTypeNames.items()}
+
+def _has_name_match(element, cache_request, text: str, control_type: str = None) -> bool:
+    """
+    Checks whether any element under a raw UIA element has a name containing
+    text (case-insensitive), optionally restricted to a control type.
+    The whole subtree is searched inside UIA in a single call. Raises
+    COMError where substring conditions are not supported.
+    """
+    uia = auto._AutomationClient.instance().IUIAutomation
+    condition = uia.CreatePropertyConditionEx(
+        auto.PropertyId.NameProperty, text,
+        _PROPERTY_CONDITION_IGNORE_CASE | _PROPERTY_CONDITION_MATCH_SUBSTRING)
+    if control_type is not None:
+        type_id = _CONTROL_TYPE_IDS.get(control_type)
+        if type_id is None:
+            type_condition = uia.CreateFalseCondition()
+        else:
+            type_condition = uia.CreatePropertyCondition(auto.PropertyId.ControlTypeProperty, type_id)
+        condition = uia.CreateAndCondition(condition, type_condition)
+    
+    return bool(element.FindFirstBuildCache(auto.TreeScope.Subtree, condition, cache_request))
+
+def _cached_control_type(element) -> str:
+    """Returns the uiautomation control type name from a cached element."""
+    return auto.ControlTypeNames.get(element.CachedControlType, "")
+
+def _cached_value(element) -> str:
+    """Returns the cached ValuePattern value, or '' if the element has none."""
+    value = element.GetCachedPropertyValue(auto.PropertyId.ValueValueProperty)
+    # Unsupported properties come back as UIA's "not supported" sentinel object
+    return value if isinstance(value, str) else ""
+
+# find_element followed by click_element walks the same window twice. Both
+# run _find_element's breadth-first walk in this process, so the second call
+# reuses the root and every children list the first one fetched through the
+# 'children' memo. The tree is kept for a short TTL and dropped as soon as a
+# tool sends input that could change the UI, so results can be at most that
+# stale. get_window_text_content shares this cache only when it walks
+# in-process; the worker process keeps its own copy and uses the generation,
+# which counts those drops, to tell when that copy is stale.
+_TREE_CACHE_TTL = 0.25
+_tree_cache = {'hwnd': None, 'ts': 0.0, 'tree': None, 'generation': 0}
+
+def _invalidate_tree_cache():
+    """Drops the cached foreground window tree."""
+    _tree_cache.update(hwnd=None, ts=0.0, tree=None, generation=_tree_cache['generation'] + 1)
+
+def _get_cached_window():
+    """
+    Returns the foreground window tree as a dict with the cached 'root'
+    element, its 'cache_request' and a 'children' memo for
+    _get_cached_children(), or None if there is no foreground window.
+    Reuses the previous tree, memo included, within the TTL.
+    """
+    hwnd = auto.GetForegroundWindow()
+    if not hwnd:
+        return None
+    
+    now = time.monotonic()
+    tree = _tree_cache['tree']
+    if tree is not None and _tree_cache['hwnd'] == hwnd and now - _tree_cache['ts'] < _TREE_CACHE_TTL:
+        return tree
+    
+    cache_request = _create_cache_request()
+    tree = {
+        'root': auto.ControlFromHandle(hwnd).Element.BuildUpdatedCache(cache_request),
+        'cache_request': cache_request,
+        'children': {}
+    }
+    _tree_cache.update(hwnd=hwnd, ts=now, tree=tree)
+    return tree
+
+# UIA calls block on IPC with the GIL released, so the children of a wide
+# tree level are fetched on a small pool to overlap those waits.
+_POOL_MIN_BATCH = 4
+
+def _init_uia_thread():
+    """Joins a pool thread to the multithreaded COM apartment."""
+    comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+
+_uia_pool = ThreadPoolExecutor(max_workers=4, initializer=_init_uia_thread)
+
+# Long tree walks run in a worker process so they don't block other tools.
+# The worker's main thread initializes COM on import like this process does,
+# and only plain dicts cross the process boundary. The spawned child
+# re-imports this file by path, which only works when it was started as a
+# script; under `fastmcp run`/`dev`/`install` it is loaded as a synthetic
+# module, so walks run on a dedicated thread in this process instead. The
+# same thread takes over for good if the worker process ever breaks.
+_uia_process = None
+_uia_process_enabled = __name__ == "__main__"
+_uia_walk_thread = ThreadPoolExecutor(max_workers=1, initializer=_init_uia_thread)
+
+def _get_uia_executor():
+    """Returns the executor for tree walks, starting the worker process on first use."""
+    global _uia_process
+    if not _uia_process_enabled:
+        return _uia_walk_thread
+    if _uia_process is None:
+        _uia_process = ProcessPoolExecutor(max_workers=1)
+    return _uia_process
+
+# --- Win32 Window Enumeration ---
+# EnumWindows and the user32 getters are direct calls, far cheaper than
+# materializing every top-level element through UIA. Owned windows
+# (dialogs) are top-level in Win32, so they are enumerated as well.
+
+# Private handles: argtypes set on the shared ctypes.windll objects would
+# leak into pyautogui, pygetwindow and uiautomation, which call the same
+# functions with their own types.
+_user32 = ctypes.WinDLL("user32", use_last_error=True)
+_dwmapi = ctypes.WinDLL("dwmapi", use_last_error=True)
+
+_EnumWindowsProc = ctypes.WINFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+_user32.EnumWindows.argtypes = [_EnumWindowsProc, wintypes.LPARAM]
+_user32.IsWindowVisible.argtypes = [wintypes.HWND]
+_user32.GetWindowLongW.argtypes = [wintypes.HWND, ctypes.c_int]
+_user32.GetWindowLongW.restype = ctypes.c_long
+_user32.GetWindowTextLengthW.argtypes = [wintypes.HWND]
+_user32.GetWindowTextW.argtypes = [wintypes.HWND, wintypes.LPWSTR, ctypes.c_int]
+_user32.GetClassNameW.argtypes = [wintypes.HWND, wintypes.LPWSTR, ctypes.c_int]
+_user32.GetWindowRect.argtypes = [wintypes.HWND, ctypes.POINTER(wintypes.RECT)]
+_user32.GetWindow.argtypes = [wintypes.HWND, ctypes.c_uint]
+_user32.GetWindow.restype = wintypes.HWND
+_user32.GetShellWindow.argtypes = []
+_user32.GetShellWindow.restype = wintypes.HWND
+_dwmapi.DwmGetWindowAttribute.argtypes = [wintypes.HWND, wintypes.DWORD, ctypes.c_void_p, wintypes.DWORD]
+
+_GWL_EXSTYLE = -20
+_GW_OWNER = 4
+_WS_EX_TOOLWINDOW = 0x00000080
+_DWMWA_CLOAKED = 14
+
+def _window_text(hwnd) -> str:
+    """Returns a window's title via GetWindowTextW."""
+    length = _user32.GetWindowTextLengthW(hwnd)
+    if not length:
+        return ""
+    buf = ctypes.create_unicode_buffer(length + 1)
+    _user32.GetWindowTextW(hwnd, buf, length + 1)
+    return buf.value
+
+def _enum_windows() -> list:
+    """
+    Lists visible, titled top-level windows in z-order.
+    Returns (hwnd, owner hwnd or None, info dict) tuples, where the info
+    dict has the title, class, position and size reported by the tools.
+    """
+    hwnds = []
+    
+    def collect(hwnd, lparam):
+        hwnds.append(hwnd)
+        return True
+    
+    _user32.EnumWindows(_EnumWindowsProc(collect), 0)
+    
+    windows = []
+    rect = wintypes.RECT()
+    cloaked = wintypes.DWORD()
+    class_buf = ctypes.create_unicode_buffer(256)
+    # The desktop ("Program Manager") is a pane in UIA, not an app window
+    shell_hwnd = _user32.GetShellWindow()
+    for hwnd in hwnds:
+        if hwnd == shell_hwnd or not _user32.IsWindowVisible(hwnd):
+            continue
+        # Tool windows (floating palettes, tray helpers) are not app windows
+        if _user32.GetWindowLongW(hwnd, _GWL_EXSTYLE) & _WS_EX_TOOLWINDOW:
+            continue
+        title = _window_text(hwnd)
+        if not title:
+            continue
+        # Suspended UWP apps and windows on other virtual desktops are cloaked
+        if _dwmapi.DwmGetWindowAttribute(hwnd, _DWMWA_CLOAKED, ctypes.byref(cloaked), ctypes.sizeof(cloaked)) == 0 and cloaked.value:
+            continue
+        if not _user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+            continue
+        w = rect.right - rect.left
+        h = rect.bottom - rect.top
+        if w <= 0 or h <= 0:
+            continue
+        
+        _user32.GetClassNameW(hwnd, class_buf, len(class_buf))
+        windows.append((hwnd, _user32.GetWindow(hwnd, _GW_OWNER), {
+            "title": title,
+            "class": class_buf.value,
+            "position": {"x": rect.left, "y": rect.top},
+            "size": {"width": w, "height": h}
+        }))
+    return windows
+
 # --- Efficient UI Context (No Screenshots!) ---
 
+# Control types checked for every visited element; frozensets give O(1)
+# lookups without rebuilding a list per element
+_CLICKABLE_TYPES = frozenset({'Button', 'Edit', 'ListItem', 'MenuItem', 'TabItem', 'Link', 'CheckBox', 'RadioButton'})
+
 @mcp.tool()
 def get_active_window() -> dict:
     """
@@ -31,184 +285,299 @@ def get_active_window() -> dict:
     except Exception as e:
         return {"error": str(e)}
 
-@mcp.tool()
-def get_window_text_content(max_depth: int = 3) -> dict:
-    """
-    Gets text content from the active window.
-    """
+class _Node:
+    """One kept element of a get_window_text_content walk."""
+    __slots__ = ('type', 'text', 'value', 'click', 'children')
+    
+    def __init__(self, control_type):
+        self.type = control_type
+        self.text = None
+        self.value = None
+        self.click = None
+        self.children = []
+    
+    def is_meaningful(self) -> bool:
+        return bool(self.text or self.value or self.children)
+    
+    def to_dict(self) -> dict:
+        """Converts the node and its subtree to the dicts the tool returns."""
+        info = {}
+        if self.text:
+            info['text'] = self.text
+        if self.value:
+            info['value'] = self.value
+        if self.click:
+            info['clickable_at'] = {"x": self.click[0], "y": self.click[1]}
+        if self.children:
+            info['children'] = [child.to_dict() for child in self.children]
+        info['type'] = self.type
+        return info
+
+def _window_text_content(max_depth: int, max_nodes: int, generation: int) -> str:
+    """Walks the active window for get_window_text_content; runs in the UIA worker process or walk thread."""
     max_depth = min(max_depth, 5)
     
-    def get_element_info(element, depth=0):
-        if depth > max_depth:
-            return None
-        
+    # Input sent by the server since the last walk makes the cached tree stale
+    if _tree_cache['generation'] != generation:
+        _invalidate_tree_cache()
+        _tree_cache['generation'] = generation
+    
+    def fetch_children(tree, element):
         try:
-            # Skip invisible elements
-            try:
-                rect = element.BoundingRectangle
-                if rect.width() == 0 or rect.height() == 0:
-                    return None
-            except:
-                pass
-
-            info = {}
-            name = element.Name
-            control_type = element.ControlTypeName
-            
-            if name:
-                info['text'] = name[:200]
-            
-            if control_type == 'Edit':
-                try:
-                    value_pattern = element.GetValuePattern()
-                    if value_pattern:
-                        val = value_pattern.Value
-                        if val: info['value'] = val[:200]
-                except:
-                    pass
-            
-            if control_type in ['Button', 'Edit', 'ListItem', 'MenuItem', 'TabItem', 'Link', 'CheckBox', 'RadioButton']:
+            return _get_cached_children(element, tree['cache_request'], tree['children'])
+        except:
+            return []
+    
+    def get_element_info(tree):
+        # Breadth-first, one tree level at a time, so that when the node
+        # budget runs out the result keeps the shallow context. Each level
+        # entry carries the children list its node joins. Visited nodes are
+        # kept in order so a reverse pass can prune empty subtrees bottom-up.
+        # Returns (root node or None, truncated).
+        visited = []
+        root_slot = []
+        level = [(tree['root'], root_slot)]
+        depth = 0
+        count = 0
+        truncated = False
+        while level:
+            expand = []
+            for element, siblings in level:
+                if count >= max_nodes:
+                    truncated = True
+                    break
+                count += 1
                 try:
-                    rect = element.BoundingRectangle
-                    info['clickable_at'] = {
-                        "x": rect.left + rect.width() // 2,
-                        "y": rect.top + rect.height() // 2
-                    }
+                    # Read each property once; the rect feeds both the visibility
+                    # check and the click point below
+                    try:
+                        rect = element.CachedBoundingRectangle
+                        w = rect.right - rect.left
+                        h = rect.bottom - rect.top
+                    except:
+                        rect = None
+                    
+                    # Skip invisible elements
+                    if rect is not None and (w == 0 or h == 0):
+                        continue
+
+                    name = element.CachedName
+                    control_type = _cached_control_type(element)
+                    
+                    # A nameless leaf can only be kept for an Edit's value
+                    if depth >= max_depth and not name and control_type != 'Edit':
+                        continue
+                    
+                    node = _Node(control_type)
+                    if name:
+                        node.text = name[:200]
+                    
+                    if control_type == 'Edit':
+                        try:
+                            val = _cached_value(element)
+                            if val: node.value = val[:200]
+                        except:
+                            pass
+                    
+                    if rect is not None and control_type in _CLICKABLE_TYPES:
+                        node.click = (rect.left + w // 2, rect.top + h // 2)
                 except:
-                    pass
+                    continue
+
+                siblings.append(node)
+                visited.append(node)
+                if depth < max_depth:
+                    expand.append((element, node))
             
-            if depth < max_depth:
-                children = []
-                try:
-                    for child in element.GetChildren():
-                        child_info = get_element_info(child, depth + 1)
-                        if child_info:
-                            children.append(child_info)
-                except:
-                    pass
-                if children:
-                    info['children'] = children
+            if truncated or not expand:
+                break
+            # Budget spent on this level: don't fetch children we won't visit
+            if count >= max_nodes:
+                truncated = True
+                break
             
-            # Only return if meaningful content
-            if 'text' in info or 'value' in info or 'children' in info:
-                info['type'] = control_type
-                return info
+            elements = [element for element, node in expand]
+            if len(elements) >= _POOL_MIN_BATCH:
+                child_lists = _uia_pool.map(fetch_children, [tree] * len(elements), elements)
+            else:
+                child_lists = [fetch_children(tree, element) for element in elements]
             
-            return None
-        except:
-            return None
+            level = []
+            for (element, node), child_elements in zip(expand, child_lists):
+                level.extend((child, node.children) for child in child_elements)
+            depth += 1
+        
+        # Children always follow their parent in visit order, so walking
+        # backwards settles every subtree before its parent is inspected.
+        for node in reversed(visited):
+            node.children = [child for child in node.children if child.is_meaningful()]
+        
+        # Only return if meaningful content
+        if root_slot and root_slot[0].is_meaningful():
+            return root_slot[0], truncated
+        return None, truncated
     
     try:
-        window = auto.GetForegroundControl()
-        if not window:
-            return {"error": "No active window"}
+        tree = _get_cached_window()
+        if not tree:
+            return _dumps({"error": "No active window"})
         
-        return {
-            "title": window.Name or "",
-            "content": get_element_info(window)
+        content, truncated = get_element_info(tree)
+        result = {
+            "title": tree['root'].CachedName or "",
+            "content": content.to_dict() if content else None
         }
+        if truncated:
+            result['truncated'] = True
+        # Serialized here so the worker sends back one string instead of
+        # pickling thousands of small dicts
+        return _dumps(result)
     except Exception as e:
-        return {"error": str(e)}
+        return _dumps({"error": str(e)})
+
+@mcp.tool()
+async def get_window_text_content(max_depth: int = 3, max_nodes: int = 2000) -> str:
+    """
+    Gets text content from the active window.
+    
+    Args:
+        max_depth: How deep to read into the element tree (capped at 5)
+        max_nodes: Maximum number of elements to visit. Shallow elements are
+            read first; the result has "truncated": true if the limit was hit.
+    """
+    global _uia_process, _uia_process_enabled
+    loop = asyncio.get_running_loop()
+    try:
+        try:
+            return await loop.run_in_executor(
+                _get_uia_executor(), _window_text_content, max_depth, max_nodes, _tree_cache['generation'])
+        except BrokenProcessPool:
+            # The worker could not import or run the walk; stay in-process
+            _uia_process_enabled = False
+            _uia_process = None
+            return await loop.run_in_executor(
+                _uia_walk_thread, _window_text_content, max_depth, max_nodes, _tree_cache['generation'])
+    except Exception as e:
+        return _dumps({"error": str(e)})
 
 @mcp.tool()
-def list_all_windows() -> list:
+def list_all_windows() -> str:
     """
     Lists all visible open windows (width/height > 0) with their titles and positions.
     Includes detected dialogs/child windows.
     """
     windows = []
     try:
-        root = auto.GetRootControl()
-        for window in root.GetChildren():
-            # Check top-level window
-            if (window.ControlTypeName == 'Window' or window.ControlTypeName == 'WindowControl') and window.Name:
-                try:
-                    rect = window.BoundingRectangle
-                    if rect.width() > 0 and rect.height() > 0:
-                        windows.append({
-                            "title": window.Name,
-                            "class": window.ClassName,
-                            "position": {"x": rect.left, "y": rect.top},
-                            "size": {"width": rect.width(), "height": rect.height()}
-                        })
-                except:
-                    pass
-                
-                # Check for immediate child windows (dialogs)
-                try:
-                    for child in window.GetChildren():
-                        if child.ControlTypeName == 'WindowControl' and child.Name:
-                            c_rect = child.BoundingRectangle
-                            if c_rect.width() > 0 and c_rect.height() > 0:
-                                windows.append({
-                                    "title": child.Name,
-                                    "class": child.ClassName,
-                                    "position": {"x": c_rect.left, "y": c_rect.top},
-                                    "size": {"width": c_rect.width(), "height": c_rect.height()},
-                                    "parent": window.Name
-                                })
-                except:
-                    pass
+        found = _enum_windows()
+        titles = {hwnd: info["title"] for hwnd, owner, info in found}
+        for hwnd, owner, info in found:
+            # Owned windows are dialogs; report the owner as their parent.
+            # Hidden owners (WinForms/Delphi/Qt main windows) are not listed,
+            # and their windows are not dialogs.
+            parent = titles.get(owner)
+            if parent:
+                info["parent"] = parent
+            windows.append(info)
     except Exception as e:
-        return [{"error": str(e)}]
-    return windows
+        return _dumps([{"error": str(e)}])
+    return _dumps(windows)
 
-def _find_element(text: str, control_type: str = None) -> list:
-    """Helper function for finding elements."""
+def _find_element(text: str, control_type: str = None, max_results: int = None) -> list:
+    """
+    Helper function for finding elements.
+    Walks the active window breadth-first to depth 6, so the shallowest
+    matches come first, and stops once max_results matches have been
+    collected (None for no limit). find_element and click_element share
+    this search, so a match one reports is the one the other clicks.
+    
+    A native UIA substring search first checks whether the window has any
+    match at all; if not, the walk is skipped. It is only an existence
+    check: results, order and the depth limit all come from the walk.
+    """
     results = []
-    text_lower = text.lower()
     
-    def search_element(element, depth=0):
-        if depth > 6:
-            return
-        
+    def add_result(element, name, elem_type):
         try:
-            name = element.Name or ""
-            elem_type = element.ControlTypeName
-            
-            if text_lower in name.lower():
-                if control_type is None or elem_type == control_type:
-                    try:
-                        rect = element.BoundingRectangle
-                        results.append({
-                            "text": name[:200],
-                            "type": elem_type,
-                            "click_x": rect.left + rect.width() // 2,
-                            "click_y": rect.top + rect.height() // 2
-                        })
-                    except:
-                        results.append({"text": name[:200], "type": elem_type})
-            
-            for child in element.GetChildren():
-                search_element(child, depth + 1)
+            rect = element.CachedBoundingRectangle
+            results.append({
+                "text": name[:200],
+                "type": elem_type,
+                "click_x": (rect.left + rect.right) // 2,
+                "click_y": (rect.top + rect.bottom) // 2
+            })
         except:
-            pass
+            results.append({"text": name[:200], "type": elem_type})
+    
+    # Compiled once so per-element matching stays in C, without allocating
+    # a lowercased copy of every name
+    pattern = re.compile(re.escape(text), re.IGNORECASE)
+    text_len = len(text)
+    
+    def search_element(root, cache_request, memo=None, depth=0):
+        queue = deque([(root, depth)])
+        while queue:
+            element, depth = queue.popleft()
+            try:
+                elem_type = _cached_control_type(element)
+                
+                # Cheap type filter first; names are only scanned on
+                # elements of the requested type
+                if control_type is None or elem_type == control_type:
+                    name = element.CachedName or ""
+                    if len(name) >= text_len and pattern.search(name):
+                        add_result(element, name, elem_type)
+                        if max_results is not None and len(results) >= max_results:
+                            return
+                
+                # Only fetch children we will actually visit
+                if depth < 6:
+                    for child in _get_cached_children(element, cache_request, memo):
+                        queue.append((child, depth + 1))
+            except:
+                pass
     
     try:
         # First try active window
-        window = auto.GetForegroundControl()
-        if window:
-            search_element(window)
+        tree = _get_cached_window()
+        if tree:
+            try:
+                has_match = _has_name_match(tree['root'], tree['cache_request'], text, control_type)
+            except comtypes.COMError:
+                # Substring conditions need Windows 10 1809+; just walk
+                has_match = True
+            if has_match:
+                search_element(tree['root'], tree['cache_request'], tree['children'])
         
         # If nothing found, try from root (depth-limited)
         if not results:
-            search_element(auto.GetRootControl(), depth=2) # Start deeper to avoid infinite root recursion
+            cache_request = _create_cache_request()
+            search_element(auto.GetRootControl().Element.BuildUpdatedCache(cache_request), cache_request, depth=2) # Start deeper to avoid infinite root recursion
             
         return results if results else [{"message": f"No elements found containing '{text}'"}]
     except Exception as e:
         return [{"error": str(e)}]
 
 @mcp.tool()
-def find_element(text: str, control_type: str = None) -> list:
+def find_element(text: str, control_type: str = None, max_results: int = 20) -> str:
     """
     Finds UI elements containing the specified text in the active window.
-    Returns clickable coordinates for each match.
+    Returns clickable coordinates for each match, shallowest first.
     
     Args:
         text: Text to search for (case-insensitive partial match)
         control_type: Optional filter by type (Button, Edit, Text, ListItem, MenuItem, etc.)
+        max_results: Maximum number of matches to return (at least 1). If more
+            matches exist, a final {"truncated": true} entry is appended.
     """
-    return _find_element(text, control_type)
+    if max_results < 1:
+        return _dumps([{"error": "max_results must be at least 1"}])
+    
+    # Ask for one extra match to tell whether the cap cut anything off
+    elements = _find_element(text, control_type, max_results + 1)
+    if len(elements) > max_results:
+        elements = elements[:max_results]
+        elements.append({"truncated": True, "message": f"Showing the first {max_results} matches"})
+    return _dumps(elements)
 
 @mcp.tool()
 def click_element(text: str, control_type: str = None) -> str:
@@ -220,10 +589,11 @@ def click_element(text: str, control_type: str = None) -> str:
         text: Text of the element to click (case-insensitive partial match)
         control_type: Optional filter (Button, MenuItem, ListItem, Link, etc.)
     """
-    elements = _find_element(text, control_type)
+    elements = _find_element(text, control_type, max_results=1)
     
     if elements and 'click_x' in elements[0]:
         x, y = elements[0]['click_x'], elements[0]['click_y']
+        _invalidate_tree_cache()
         try:
             pyautogui.click(x, y)
             return f"Clicked '{elements[0]['text']}' at ({x}, {y})"
@@ -243,20 +613,20 @@ def focus_window(title: str) -> str:
         title: Part of the window title to match
     """
     title_lower = title.lower()
+    _invalidate_tree_cache()
     try:
-        root = auto.GetRootControl()
-        for window in root.GetChildren():
-            if (window.ControlTypeName == 'Window' or window.ControlTypeName == 'WindowControl') and window.Name:
-                if title_lower in window.Name.lower():
-                    window.SetFocus()
-                    return f"Focused window: {window.Name}"
-                
-                # Check children (dialogs)
-                for child in window.GetChildren():
-                    if child.ControlTypeName == 'WindowControl' and child.Name:
-                        if title_lower in child.Name.lower():
-                            child.SetFocus()
-                            return f"Focused window: {child.Name} (child of {window.Name})"
+        # One pass over the Win32 window list; owned dialogs are top-level
+        # there, so no per-window child walk is needed
+        found = _enum_windows()
+        titles = {hwnd: info["title"] for hwnd, owner, info in found}
+        for hwnd, owner, info in found:
+            if title_lower in info["title"].lower():
+                auto.ControlFromHandle(hwnd).SetFocus()
+                # Hidden owners are not listed; their windows are not dialogs
+                parent = titles.get(owner)
+                if parent:
+                    return f"Focused window: {info['title']} (child of {parent})"
+                return f"Focused window: {info['title']}"
                             
         return f"No window found matching '{title}'"
     except Exception as e:
@@ -290,6 +660,7 @@ def mouse_action(action: str, x: int = None, y: int = None, button: str = 'left'
         clicks: Number of clicks (for scroll).
         duration: Drag duration.
     """
+    _invalidate_tree_cache()
     try:
         if action == 'move':
             if x is None or y is None: return "Error: x and y required for move"
@@ -338,6 +709,7 @@ def keyboard_action(action: str, text: str = None, key: str = None, keys: list[s
         keys: List of keys for hotkey.
         interval: Typing interval.
     """
+    _invalidate_tree_cache()
     try:
         if action == 'type':
             if not text: return "Error: text required"
@@ -371,13 +743,20 @@ def take_screenshot_region(x: int, y: int, width: int, height: int) -> str:
         width: Width of region
         height: Height of region
     """
-    import base64
     import io
+    import mss
+    import pybase64
+    from PIL import Image
     
-    screenshot = pyautogui.screenshot(region=(x, y, width, height))
+    # mss copies only the requested region instead of grabbing the full screen
+    with mss.mss() as sct:
+        raw = sct.grab({"left": x, "top": y, "width": width, "height": height})
+    screenshot = Image.frombytes("RGB", raw.size, raw.rgb)
     buffered = io.BytesIO()
-    screenshot.save(buffered, format="PNG", optimize=True)
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    # Fast zlib level and no optimize pass; encode time dominates for small regions
+    screenshot.save(buffered, format="PNG", compress_level=1)
+    # pybase64 encodes with SIMD; base64 output is always ASCII
+    img_str = pybase64.b64encode(buffered.getvalue()).decode("ascii")
     return img_str
 
 